@@ -69,6 +69,10 @@ def cleanup_profile_instance(profile_name=None):
     
     instances = getattr(mw, TTS_INSTANCE_KEY)
     if profile_name in instances:
+        instance = instances[profile_name]
+        instance.flush_config()
+        instance.close_cache_index()
+        instance.close_connections()
         del instances[profile_name]
         print(f"Gemini TTS: Cleaned up instance for profile '{profile_name}'")
 
@@ -14,6 +14,8 @@ from aqt.qt import (QDialog, QVBoxLayout, QFormLayout, QLineEdit, QComboBox,
                     QHBoxLayout, QLabel, QGroupBox, QTabWidget, QWidget,
                     QSlider, QTextEdit, QFrame, Qt)
 
+from .tts_engine import ApiKeyError, RateLimitError
+
 def show_config_dialog():
     """Show the configuration dialog for Gemini TTS."""
     try:
@@ -186,6 +188,17 @@ class ConfigDialog(QDialog):
         self.cache_days.setSuffix(" days")
         cache_form.addRow("Keep cache for:", self.cache_days)
         
+        self.cache_max_mb = QSpinBox()
+        self.cache_max_mb.setRange(10, 10000)
+        self.cache_max_mb.setSuffix(" MB")
+        cache_form.addRow("Max cache size:", self.cache_max_mb)
+        
+        self.cache_max_entries = QSpinBox()
+        self.cache_max_entries.setRange(100, 100000)
+        self.cache_max_entries.setSingleStep(100)
+        self.cache_max_entries.setSuffix(" files")
+        cache_form.addRow("Max cached files:", self.cache_max_entries)
+        
         layout.addWidget(cache_group)
         
         # Performance Group
@@ -297,8 +310,8 @@ class ConfigDialog(QDialog):
         """Create action buttons section."""
         button_layout = QHBoxLayout()
         
-        # Test button
-        test_btn = QPushButton("Test API Key")
+        # Test button (makes a real API call)
+        test_btn = QPushButton("Test Connection")
         test_btn.clicked.connect(self.test_api_key)
         button_layout.addWidget(test_btn)
         
@@ -360,6 +373,8 @@ class ConfigDialog(QDialog):
         # Cache settings
         self.cache_enabled.setChecked(config.get("enable_cache", True))
         self.cache_days.setValue(config.get("cache_days", 30))
+        self.cache_max_mb.setValue(config.get("cache_max_mb", 500))
+        self.cache_max_entries.setValue(config.get("cache_max_entries", 5000))
         
         # Performance settings
         self.enable_fallback.setChecked(config.get("enable_fallback", True))
@@ -398,6 +413,8 @@ class ConfigDialog(QDialog):
             "thinking_budget": self.thinking_budget_slider.value(),
             "enable_cache": self.cache_enabled.isChecked(),
             "cache_days": self.cache_days.value(),
+            "cache_max_mb": self.cache_max_mb.value(),
+            "cache_max_entries": self.cache_max_entries.value(),
             "enable_fallback": self.enable_fallback.isChecked(),
             "cache_preprocessing": self.cache_preprocessing.isChecked(),
             
@@ -417,7 +434,7 @@ class ConfigDialog(QDialog):
             QMessageBox.critical(self, "Error", f"Failed to save configuration:\n{e}")
     
     def test_api_key(self):
-        """Test the entered API key with current settings."""
+        """Test the entered API key with a real API request."""
         api_key = self.api_key_input.text().strip()
         
         if not api_key:
@@ -436,11 +453,16 @@ class ConfigDialog(QDialog):
         
         # Temporarily update config for test
         original_config = self.tts.config
-        self.tts.config = test_config
+        self.tts.apply_config(test_config)
         
         try:
-            test_text = "Hello, this is a test."
-            audio_data = self.tts.generate_audio_http(test_text)
+            # Check settings locally before spending quota on a round-trip
+            valid, message = self.tts.validate_current_settings()
+            if not valid:
+                QMessageBox.warning(self, "Error", message)
+                return
+            
+            audio_data = self.tts.probe_api()
             
             if len(audio_data) > 1000:
                 QMessageBox.information(
@@ -453,21 +475,18 @@ class ConfigDialog(QDialog):
                     "API key works but audio data seems small. Check your configuration."
                 )
                 
+        except ApiKeyError as e:
+            QMessageBox.critical(self, "Error", str(e))
+        except RateLimitError:
+            QMessageBox.warning(
+                self, "Rate Limited", 
+                "Rate limited. API key is likely valid, try again later."
+            )
         except Exception as e:
-            error_msg = str(e)
-            
-            if "403" in error_msg or "Invalid API key" in error_msg:
-                QMessageBox.critical(self, "Error", "Invalid API key or access denied")
-            elif "429" in error_msg or "Rate limited" in error_msg:
-                QMessageBox.warning(
-                    self, "Rate Limited", 
-                    "Rate limited. API key is likely valid, try again later."
-                )
-            else:
-                QMessageBox.critical(self, "Error", f"API test failed:\n{error_msg}")
+            QMessageBox.critical(self, "Error", f"API test failed:\n{e}")
         
         finally:
-            self.tts.config = original_config
+            self.tts.apply_config(original_config)
     
     def test_unified_mode(self):
         """Test unified mode with sample structured text."""
@@ -495,7 +514,7 @@ class ConfigDialog(QDialog):
         })
         
         original_config = self.tts.config
-        self.tts.config = test_config
+        self.tts.apply_config(test_config)
         
         try:
             # Test unified preprocessing
@@ -517,7 +536,7 @@ class ConfigDialog(QDialog):
             QMessageBox.critical(self, "Error", f"Unified mode test failed:\n{e}")
         
         finally:
-            self.tts.config = original_config
+            self.tts.apply_config(original_config)
     
     def preview_processing(self):
         """Preview text processing with current settings."""
@@ -8,41 +8,312 @@ intelligent content analysis, and enhanced caching system.
 """
 
 import os
+import re
 import json
 import base64
 import hashlib
 import time
 import struct
-import urllib.request
-import urllib.parse
-import urllib.error
+import shutil
+import sqlite3
 import html
-import tempfile
-from typing import Optional, Dict, Any, Tuple
-from functools import partial
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from types import MappingProxyType
+from typing import Optional, Dict, Any, List, Tuple, Mapping
+from functools import partial, lru_cache, cached_property
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+# Bundled with Anki (anki.httpclient uses it); honours proxy settings
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 from aqt import mw
 from aqt.qt import QTimer, QMenu, QCursor
 from aqt.utils import tooltip
 
+# ============================================================================
+# ERRORS
+# ============================================================================
+# All subclass ValueError so existing ``except ValueError`` handlers still
+# catch them; the UI dispatches on the specific type.
+
+class ApiKeyError(ValueError):
+    """API key missing or rejected by the API."""
+
+class RateLimitError(ValueError):
+    """API rate limit still exceeded after retrying."""
+
+class NetworkError(ValueError):
+    """Connection to the API failed."""
+
+class TextTooLongError(ValueError):
+    """Text exceeds the per-request character limit."""
+
+# Gemini API keys are long URL-safe tokens
+_API_KEY_RE = re.compile(r'^[A-Za-z0-9_-]{20,}$')
+
+# Text normalization patterns
+_HTML_TAG_RE = re.compile(r'<[^>]+>')
+# List markers at the start of a line, at most one of each kind in this
+# order (symbol bullet, dash/star/plus, "1." or "1)", "a." or "a)").
+# Every part is optional, so match() always succeeds.
+_BULLET_PREFIX_RE = re.compile(
+    r'\s*'
+    r'(?:[•·‣⁃▪▫‧◦⦾⦿]\s*)?'
+    r'(?:[-*+]\s*)?'
+    r'(?:\d+[.)]\s*)?'
+    r'(?:[a-zA-Z][.)]\s*)?'
+)
+_WS_RE = re.compile(r'\s+')
+_WS_TABLE = str.maketrans({
+    '\u00a0': ' ',   # Non-breaking space
+    '\u2000': ' ',   # En quad
+    '\u2001': ' ',   # Em quad
+    '\u2002': ' ',   # En space
+    '\u2003': ' ',   # Em space
+    '\u2009': ' ',   # Thin space
+    '\u200b': None,  # Zero-width space
+})
+
+# Gemini API endpoint; requests share one keep-alive session per engine
+_API_BASE = "https://generativelanguage.googleapis.com"
+_API_HEADERS = MappingProxyType({'Content-Type': 'application/json'})
+# Rate limits and server errors are retried with exponential backoff.
+# Read errors are not: the request may already have been billed.
+_API_RETRY = Retry(
+    total=3, read=0, backoff_factor=0.5,
+    status_forcelist=(429, 500, 502, 503, 504),
+    allowed_methods=frozenset(("POST",)),
+    raise_on_status=False,
+)
+
+# Cache index: one row per cached <cache_key>.wav file, plus the media
+# folder file last handed out for it
+_CACHE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    cache_key TEXT PRIMARY KEY,
+    created REAL NOT NULL,
+    accessed REAL NOT NULL,
+    size INTEGER NOT NULL DEFAULT 0,
+    media_filename TEXT
+);
+CREATE INDEX IF NOT EXISTS files_accessed ON files (accessed);
+CREATE INDEX IF NOT EXISTS files_created ON files (created);
+"""
+
+
+# Linux ioctl that makes dst share src's extents (btrfs, XFS reflinks)
+_FICLONE = 0x40049409
+
+def _clone_file(src: str, dst: str):
+    """Copy a file, as a copy-on-write reflink where the filesystem allows."""
+    if fcntl is not None:
+        try:
+            with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+                fcntl.ioctl(fdst.fileno(), _FICLONE, fsrc.fileno())
+            return
+        except OSError:
+            pass
+    shutil.copyfile(src, dst)
+
+# Flags for exclusively creating a cache temp file (binary mode on Windows)
+_TEMP_OPEN_FLAGS = os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, 'O_BINARY', 0)
+
+def _write_all(fd: int, data: bytes):
+    """Write bytes to a raw file descriptor in 64 KiB chunks."""
+    view = memoryview(data)
+    offset = 0
+    while offset < len(view):
+        offset += os.write(fd, view[offset:offset + 65536])
+
+@lru_cache(maxsize=256)
+def _compute_cache_key(text: str, settings: bytes) -> str:
+    """Hash text and its encoded generation settings into a cache key."""
+    # SHA-256 goes through OpenSSL, which uses the CPU's SHA extensions
+    hasher = hashlib.sha256(text.encode('utf-8'))
+    hasher.update(settings)
+    return hasher.hexdigest()[:32]
+
+# Content analysis results are reused across the mode check and the
+# unified request, and across repeat plays of the same text
+@lru_cache(maxsize=256)
+def _analyze_structure(analyzer, text: str) -> Mapping[str, Any]:
+    """Memoized ContentAnalyzer.analyze_structure(), as a read-only mapping."""
+    return MappingProxyType(analyzer.analyze_structure(text))
+
+# Short one-line text without brackets or double spaces always analyzes
+# as low complexity with no lists
+_SIMPLE_TEXT_MAX_LENGTH = 100
+_BRACKETS_RE = re.compile(r'[{}()\[\]<>]')
+
+# Number of media files remembered for repeat requests within a session
+_SESSION_CACHE_SIZE = 128
+
+# Concurrent API requests made by generate_audio_batch()
+_BATCH_MAX_WORKERS = 8
+
+# Compact JSON to/from UTF-8 bytes, using orjson when Anki provides it
+if orjson is not None:
+    _json_dumps = orjson.dumps
+    _json_loads = orjson.loads
+else:
+    _json_encode = json.JSONEncoder(separators=(',', ':')).encode
+    
+    def _json_dumps(obj: Any) -> bytes:
+        return _json_encode(obj).encode('utf-8')
+    _json_loads = json.loads
+
+# Read-only model/voice tables shared by every caller
+_AVAILABLE_MODELS = MappingProxyType({
+    "flash_unified": MappingProxyType({
+        "model_id": "gemini-2.5-flash-preview-06-05",
+        "display_name": "Gemini 2.5 Flash (Unified)",
+        "description": "AI preprocessing + TTS in one call",
+        "mode": "unified",
+        "thinking_budget_range": (0, 24576)
+    }),
+    "pro_unified": MappingProxyType({
+        "model_id": "gemini-2.5-pro-preview-06-05",
+        "display_name": "Gemini 2.5 Pro (Unified)",
+        "description": "Best quality with AI preprocessing",
+        "mode": "unified",
+        "thinking_budget_range": (128, 32768)
+    }),
+    "flash_tts": MappingProxyType({
+        "model_id": "gemini-2.5-flash-preview-tts",
+        "display_name": "Gemini 2.5 Flash (TTS Only)",
+        "description": "Traditional TTS without preprocessing",
+        "mode": "traditional"
+    }),
+    "pro_tts": MappingProxyType({
+        "model_id": "gemini-2.5-pro-preview-tts",
+        "display_name": "Gemini 2.5 Pro (TTS Only)",
+        "description": "High quality traditional TTS",
+        "mode": "traditional"
+    })
+})
+
+_AVAILABLE_VOICES = (
+    "Zephyr", "Puck", "Charon", "Kore", "Fenrir", "Leda", "Orus", "Aoede",
+    "Callirhoe", "Autonoe", "Enceladus", "Iapetus", "Umbriel", "Algieba",
+    "Despina", "Erinome", "Algenib", "Rasalgethi", "Laomedeia", "Achernar",
+    "Alnilam", "Schedar", "Gacrux", "Pulcherrima", "Achird", "Zubenelgenubi",
+    "Vindemiatrix", "Sadachbia", "Sadaltager", "Sulafat"
+)
+_AVAILABLE_VOICE_SET = frozenset(_AVAILABLE_VOICES)
+
+# Processing mode menu entries (key, label)
+_PROCESSING_MODE_MENU = (
+    ("unified", "Unified (AI + TTS)"),
+    ("traditional", "Traditional (TTS Only)"),
+    ("hybrid", "Hybrid (Auto-Select)"),
+    ("auto", "Auto-Detect"),
+)
+
+# Editor script returning the current selection as plain text. Only the
+# text is sent back; the selection's HTML was never used (an empty text
+# selection is rejected before any fallback could apply).
+_SELECTION_JS = """
+(function() {
+    const text = window.getSelection().toString();
+    return {
+        plainText: text,
+        hasContent: text.length > 0
+    };
+})();
+"""
+
+# Editor toolbar icon, resolved once at import (None if the file is missing)
+_ADDON_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+_ICON_PATH = os.path.join(_ADDON_DIR, "icons", "gemini.png")
+_ICON_OR_NONE = _ICON_PATH if os.path.exists(_ICON_PATH) else None
+
+# 44-byte PCM WAV header: RIFF chunk, fmt subchunk, data subchunk header.
+# The fixed middle (b'WAVE' through b'data') is packed with _WAV_HDR_BODY;
+# the RIFF and data sizes on either side are packed with _WAV_SIZE.
+_WAV_HDR_BODY = struct.Struct('<4s4sIHHIIHH4s')
+_WAV_SIZE = struct.Struct('<I')
+
+@lru_cache(maxsize=8)
+def _wav_header_body(sample_rate: int) -> bytes:
+    """Return the fixed WAV header bytes from b'WAVE' through b'data'.
+    
+    Only the RIFF and data chunk sizes vary with the payload length.
+    """
+    channels = 1
+    bits_per_sample = 16
+    bytes_per_sample = bits_per_sample // 8
+    byte_rate = sample_rate * channels * bytes_per_sample
+    block_align = channels * bytes_per_sample
+    
+    return _WAV_HDR_BODY.pack(
+        b'WAVE', b'fmt ', 16, 1, channels,
+        sample_rate, byte_rate, block_align, bits_per_sample, b'data'
+    )
+
+@lru_cache(maxsize=16)
+def _sample_rate_from_mime(mime_type: str) -> int:
+    """Parse the sample rate from an audio MIME type (default 24000 Hz)."""
+    if 'rate=' in mime_type:
+        try:
+            return int(mime_type.split('rate=')[1].split(';')[0])
+        except (ValueError, IndexError):
+            pass
+    return 24000
+
 class GeminiTTS:
     """Enhanced TTS engine with unified preprocessing and audio generation."""
     
     def __init__(self):
         """Initialize the TTS engine with configuration and cache setup."""
         self.config = self.load_config()
-        self.cache_dir = os.path.join(mw.col.media.dir(), ".gemini_cache")
+        # Guards the values memoized from self.config against a config
+        # change on the main thread while a worker is filling them
+        self._config_lock = threading.Lock()
+        self._cache_key_settings = {}
+        self._current_model_info = None
+        self._success_message = None
+        self._pending_config = None
+        self._media_dir = os.path.abspath(mw.col.media.dir())
+        self._media_dir_prefix = self._media_dir + os.sep
+        self.cache_dir = os.path.join(self._media_dir, ".gemini_cache")
+        self._cache_dir_prefix = self.cache_dir + os.sep
+        self.cache_db_file = os.path.join(self.cache_dir, "cache.db")
         self.cache_metadata_file = os.path.join(self.cache_dir, "cache_metadata.json")
+        
+        # Keep-alive HTTPS session shared by all threads; see _post_json()
+        self._http = requests.Session()
+        self._http.mount("https://", HTTPAdapter(
+            pool_maxsize=_BATCH_MAX_WORKERS, max_retries=_API_RETRY))
+        # Batch workers, kept across batches; threads start on first use
+        self._batch_executor = ThreadPoolExecutor(
+            max_workers=_BATCH_MAX_WORKERS, thread_name_prefix="gemini_tts")
+        
+        # Guards cache state shared with background generation tasks
+        self._meta_lock = threading.RLock()
+        
         self.create_cache_dir()
-        self.cache_metadata = self.load_cache_metadata()
+        self._cache_db_conn = None
+        self._cache_db_closed = False
         
-        # Initialize content analyzer
-        try:
-            from .content_analyzer import ContentAnalyzer
-            self.content_analyzer = ContentAnalyzer()
-        except ImportError:
-            self.content_analyzer = None
-            print("Warning: ContentAnalyzer not available, using fallback")
+        # Media files generated this session: cache_key -> filename
+        self._session_cache = OrderedDict()
+        
+        # Open the cache index and expire old entries without blocking
+        # profile load
+        threading.Thread(target=self._background_cleanup, daemon=True).start()
     
     # ========================================================================
     # CONFIGURATION MANAGEMENT
@@ -62,6 +333,8 @@ class GeminiTTS:
             "thinking_budget": 0,
             "enable_cache": True,
             "cache_days": 30,
+            "cache_max_mb": 500,
+            "cache_max_entries": 5000,
             "enable_fallback": True,
             "cache_preprocessing": True,
             
@@ -86,67 +359,94 @@ class GeminiTTS:
             mw.col.set_config("gemini_tts", config)
         except AttributeError:
             mw.col.conf["gemini_tts"] = config
-        self.config = config
+        # A full save supersedes any debounced toolbar change
+        self._pending_config = None
+        self.apply_config(config)
+    
+    def apply_config(self, config: Dict[str, Any]):
+        """Make config current in memory and drop values derived from it.
+        
+        Unlike save_config() nothing is written to the collection; use this
+        (not a plain assignment to self.config) to swap config temporarily.
+        """
+        with self._config_lock:
+            self.config = config
+            self._cache_key_settings.clear()
+            self._current_model_info = None
+            self._success_message = None
+    
+    def flush_config(self):
+        """Write a pending toolbar change to the collection, if any."""
+        config = self._pending_config
+        if config is not None:
+            self.save_config(config)
     
     # ========================================================================
     # MODEL AND VOICE MANAGEMENT
     # ========================================================================
     
-    def get_available_models(self) -> Dict[str, Dict[str, Any]]:
+    def get_available_models(self) -> Mapping[str, Mapping[str, Any]]:
         """Get available TTS models including unified options."""
-        return {
-            "flash_unified": {
-                "model_id": "gemini-2.5-flash-preview-06-05",
-                "display_name": "Gemini 2.5 Flash (Unified)",
-                "description": "AI preprocessing + TTS in one call",
-                "mode": "unified",
-                "thinking_budget_range": (0, 24576)
-            },
-            "pro_unified": {
-                "model_id": "gemini-2.5-pro-preview-06-05",
-                "display_name": "Gemini 2.5 Pro (Unified)",
-                "description": "Best quality with AI preprocessing",
-                "mode": "unified",
-                "thinking_budget_range": (128, 32768)
-            },
-            "flash_tts": {
-                "model_id": "gemini-2.5-flash-preview-tts",
-                "display_name": "Gemini 2.5 Flash (TTS Only)",
-                "description": "Traditional TTS without preprocessing",
-                "mode": "traditional"
-            },
-            "pro_tts": {
-                "model_id": "gemini-2.5-pro-preview-tts",
-                "display_name": "Gemini 2.5 Pro (TTS Only)", 
-                "description": "High quality traditional TTS",
-                "mode": "traditional"
-            }
-        }
+        return _AVAILABLE_MODELS
     
-    def get_current_model_info(self) -> Dict[str, Any]:
+    def get_current_model_info(self) -> Mapping[str, Any]:
         """Get information about the currently selected model."""
-        models = self.get_available_models()
-        model_key = self.config.get("model", "flash_unified")
-        return models.get(model_key, models["flash_unified"])
+        # Memoized until the next save_config()
+        with self._config_lock:
+            info = self._current_model_info
+            if info is None:
+                model_key = self.config.get("model", "flash_unified")
+                info = self._current_model_info = _AVAILABLE_MODELS.get(
+                    model_key, _AVAILABLE_MODELS["flash_unified"])
+            return info
     
-    def get_available_voices(self):
+    def get_available_voices(self) -> Tuple[str, ...]:
         """Get list of available Gemini TTS voices."""
-        return [
-            "Zephyr", "Puck", "Charon", "Kore", "Fenrir", "Leda", "Orus", "Aoede",
-            "Callirhoe", "Autonoe", "Enceladus", "Iapetus", "Umbriel", "Algieba", 
-            "Despina", "Erinome", "Algenib", "Rasalgethi", "Laomedeia", "Achernar",
-            "Alnilam", "Schedar", "Gacrux", "Pulcherrima", "Achird", "Zubenelgenubi",
-            "Vindemiatrix", "Sadachbia", "Sadaltager", "Sulafat"
-        ]
+        return _AVAILABLE_VOICES
+    
+    def validate_current_settings(self) -> Tuple[bool, str]:
+        """Validate current configuration locally without calling the API."""
+        api_key = self.config.get("api_key", "").strip()
+        if not api_key:
+            return False, "API key not configured"
+        
+        if not _API_KEY_RE.match(api_key):
+            return False, "API key format looks invalid"
+        
+        if self.config.get("voice") not in _AVAILABLE_VOICE_SET:
+            return False, f"Unknown voice: {self.config.get('voice')}"
+        
+        if self.config.get("model") not in self.get_available_models():
+            return False, f"Unknown model: {self.config.get('model')}"
+        
+        return True, "Settings look valid"
+    
+    def probe_api(self, text: str = "Hello, this is a test.") -> bytes:
+        """Make a real TTS request to verify the API key (uses quota).
+        
+        Returns the PCM audio without its WAV header. Called from the config
+        dialog, so errors are reported at once rather than retried.
+        """
+        return self.generate_audio_http(text, retry=False)[1]
     
     # ========================================================================
     # CONTENT ANALYSIS AND PREPROCESSING
     # ========================================================================
     
-    def analyze_content(self, text: str) -> Dict[str, Any]:
+    @cached_property
+    def content_analyzer(self):
+        """ContentAnalyzer instance, created on first use (None if unavailable)."""
+        try:
+            from .content_analyzer import ContentAnalyzer
+        except ImportError:
+            print("Warning: ContentAnalyzer not available, using fallback")
+            return None
+        return ContentAnalyzer()
+    
+    def analyze_content(self, text: str) -> Mapping[str, Any]:
         """Analyze content structure for optimal processing."""
         if self.content_analyzer:
-            return self.content_analyzer.analyze_structure(text)
+            return _analyze_structure(self.content_analyzer, text)
         else:
             # Fallback analysis
             return {
@@ -156,7 +456,7 @@ class GeminiTTS:
                 "preprocessing_strategy": "enhanced"
             }
     
-    def build_preprocessing_prompt(self, text: str, analysis: Dict[str, Any]) -> str:
+    def build_preprocessing_prompt(self, text: str, analysis: Mapping[str, Any]) -> str:
         """Build intelligent preprocessing prompt based on content analysis."""
         content_type = analysis.get("type", "general")
         style = self.config.get("preprocessing_style", "natural")
@@ -188,10 +488,18 @@ Generate natural speech text:"""
         elif processing_mode == "unified":
             return True
         elif processing_mode == "auto":
+            # Lists need at least two lines
+            if '\n' not in text:
+                return False
+            
             # Auto-detect based on content structure
             analysis = self.analyze_content(text)
             return analysis.get("has_bullets", False) or analysis.get("has_numbers", False)
         elif processing_mode == "hybrid":
+            if (len(text) < _SIMPLE_TEXT_MAX_LENGTH and '\n' not in text
+                    and '  ' not in text and not _BRACKETS_RE.search(text)):
+                return False
+            
             # Use unified for complex content, traditional for simple
             analysis = self.analyze_content(text)
             return analysis.get("complexity", "medium") != "low"
@@ -202,11 +510,48 @@ Generate natural speech text:"""
     # UNIFIED AUDIO GENERATION
     # ========================================================================
     
-    def generate_audio_unified(self, text: str) -> bytes:
-        """Generate audio using unified preprocessing + TTS in single API call."""
+    def _post_json(self, path: str, body: bytes, timeout: float,
+                   retry: bool = True) -> Dict[str, Any]:
+        """POST a JSON body to the Gemini API over the shared session.
+        
+        Rate limits and server errors are retried with backoff (unless
+        retry is False) before being mapped to the usual error messages.
+        """
+        url = _API_BASE + path
+        try:
+            if retry:
+                response = self._http.post(url, data=body, headers=_API_HEADERS,
+                                           timeout=timeout)
+            else:
+                with requests.Session() as session:
+                    response = session.post(url, data=body, headers=_API_HEADERS,
+                                            timeout=timeout)
+        except requests.RequestException as e:
+            raise NetworkError(f"Network error: {e}")
+        
+        status = response.status_code
+        if status == 400:
+            raise ApiKeyError("Invalid request - check API key and text")
+        elif status == 403:
+            raise ApiKeyError("Invalid API key or access denied")
+        elif status == 429:
+            raise RateLimitError("Rate limited - please wait and try again")
+        elif status != 200:
+            raise ValueError(f"API error {status}: {response.reason}")
+        
+        try:
+            return _json_loads(response.content)
+        except json.JSONDecodeError:
+            raise ValueError("Invalid response from API")
+    
+    def generate_audio_unified(self, text: str) -> Tuple[bytes, bytes]:
+        """Generate audio using unified preprocessing + TTS in single API call.
+        
+        Returns the WAV header and PCM data; see convert_to_wav().
+        """
         api_key = self.config.get("api_key", "").strip()
         if not api_key:
-            raise ValueError("API key not configured")
+            raise ApiKeyError("API key not configured")
         
         # Analyze content for optimal processing
         analysis = self.analyze_content(text)
@@ -223,7 +568,7 @@ Generate natural speech text:"""
             # Fall back to using the unified version
             model_id = "gemini-2.5-flash-preview-06-05"
         
-        url = f"https://generativelanguage.googleapis.com/v1beta/models/{model_id}:generateContent?key={api_key}"
+        path = f"/v1beta/models/{model_id}:generateContent?key={api_key}"
         
         # Build API payload
         payload = {
@@ -277,30 +622,7 @@ Generate natural speech text:"""
                 "includeThoughts": False
             }
         
-        try:
-            request = urllib.request.Request(
-                url,
-                data=json.dumps(payload).encode('utf-8'),
-                headers={'Content-Type': 'application/json'}
-            )
-            
-            with urllib.request.urlopen(request, timeout=45) as response:  # Longer timeout for unified processing
-                response_data = json.loads(response.read().decode('utf-8'))
-            
-        except urllib.error.HTTPError as e:
-            if e.code == 400:
-                raise ValueError("Invalid request - check API key and text")
-            elif e.code == 403:
-                raise ValueError("Invalid API key or access denied")
-            elif e.code == 429:
-                # Implement exponential backoff
-                raise ValueError("Rate limited - please wait and try again")
-            else:
-                raise ValueError(f"API error {e.code}: {e.reason}")
-        except urllib.error.URLError as e:
-            raise ValueError(f"Network error: {e.reason}")
-        except json.JSONDecodeError:
-            raise ValueError("Invalid response from API")
+        response_data = self._post_json(path, _json_dumps(payload), timeout=45)  # Longer timeout for unified processing
         
         # Extract audio data
         try:
@@ -320,18 +642,20 @@ Generate natural speech text:"""
             
             audio_data = base64.b64decode(audio_b64)
             mime_type = inline_data.get('mimeType', 'audio/L16;rate=24000')
-            wav_data = self.convert_to_wav(audio_data, mime_type)
-            
-            return wav_data
+            return self.convert_to_wav(audio_data, mime_type)
             
         except (KeyError, IndexError, TypeError) as e:
             raise ValueError(f"Unexpected API response format: {e}")
     
-    def generate_audio_http(self, text: str) -> bytes:
-        """Generate audio using traditional HTTP request to Gemini TTS API."""
+    def generate_audio_http(self, text: str, retry: bool = True) -> Tuple[bytes, bytes]:
+        """Generate audio using traditional HTTP request to Gemini TTS API.
+        
+        Returns the WAV header and PCM data; see convert_to_wav(). Pass
+        retry=False to fail fast instead of backing off on rate limits.
+        """
         api_key = self.config.get("api_key", "").strip()
         if not api_key:
-            raise ValueError("API key not configured")
+            raise ApiKeyError("API key not configured")
         
         model_info = self.get_current_model_info()
         model_id = model_info["model_id"]
@@ -343,7 +667,7 @@ Generate natural speech text:"""
         voice = self.config.get("voice", "Zephyr")
         temperature = self.config.get("temperature", 0.0)
         
-        url = f"https://generativelanguage.googleapis.com/v1beta/models/{model_id}:generateContent?key={api_key}"
+        path = f"/v1beta/models/{model_id}:generateContent?key={api_key}"
         
         payload = {
             "contents": [{"parts": [{"text": text}]}],
@@ -376,29 +700,8 @@ Generate natural speech text:"""
             ]
         }
         
-        try:
-            request = urllib.request.Request(
-                url,
-                data=json.dumps(payload).encode('utf-8'),
-                headers={'Content-Type': 'application/json'}
-            )
-            
-            with urllib.request.urlopen(request, timeout=30) as response:
-                response_data = json.loads(response.read().decode('utf-8'))
-            
-        except urllib.error.HTTPError as e:
-            if e.code == 400:
-                raise ValueError("Invalid request - check API key and text")
-            elif e.code == 403:
-                raise ValueError("Invalid API key or access denied")
-            elif e.code == 429:
-                raise ValueError("Rate limited - please wait and try again")
-            else:
-                raise ValueError(f"API error {e.code}: {e.reason}")
-        except urllib.error.URLError as e:
-            raise ValueError(f"Network error: {e.reason}")
-        except json.JSONDecodeError:
-            raise ValueError("Invalid response from API")
+        response_data = self._post_json(path, _json_dumps(payload), timeout=30,
+                                        retry=retry)
         
         try:
             candidates = response_data.get('candidates', [])
@@ -417,9 +720,7 @@ Generate natural speech text:"""
             
             audio_data = base64.b64decode(audio_b64)
             mime_type = inline_data.get('mimeType', 'audio/L16;rate=24000')
-            wav_data = self.convert_to_wav(audio_data, mime_type)
-            
-            return wav_data
+            return self.convert_to_wav(audio_data, mime_type)
             
         except (KeyError, IndexError, TypeError) as e:
             raise ValueError(f"Unexpected API response format: {e}")
@@ -433,72 +734,145 @@ Generate natural speech text:"""
         if not (editor and hasattr(editor, 'note') and editor.note):
             return "Front"
         
-        if hasattr(editor, 'currentField') and editor.currentField is not None:
-            field_names = list(editor.note.keys())
-            if 0 <= editor.currentField < len(field_names):
-                return field_names[editor.currentField]
+        field_names = editor.note.keys()
+        current = getattr(editor, 'currentField', None)
+        if current is not None and 0 <= current < len(field_names):
+            return field_names[current]
         
-        field_names = list(editor.note.keys())
         return field_names[0] if field_names else "Front"
     
     # ========================================================================
     # ENHANCED CACHE MANAGEMENT SYSTEM
     # ========================================================================
     
-    def load_cache_metadata(self) -> Dict[str, Any]:
-        """Load cache metadata for efficient cleanup."""
-        if not os.path.exists(self.cache_metadata_file):
-            return {"version": "2.0", "files": {}}
+    @property
+    def _cache_db(self) -> sqlite3.Connection:
+        """Cache index connection, opened on first use.
         
+        Raises sqlite3.ProgrammingError once close_cache_index() has run,
+        so late background work cannot reopen the index.
+        """
+        with self._meta_lock:
+            if self._cache_db_closed:
+                raise sqlite3.ProgrammingError("Cache index is closed")
+            if self._cache_db_conn is None:
+                self._cache_db_conn = self.open_cache_index()
+            return self._cache_db_conn
+    
+    def open_cache_index(self) -> sqlite3.Connection:
+        """Open the SQLite cache index, migrating older JSON metadata."""
         try:
-            with open(self.cache_metadata_file, 'r', encoding='utf-8') as f:
-                metadata = json.load(f)
-                if "files" not in metadata:
-                    metadata["files"] = {}
-                return metadata
-        except (json.JSONDecodeError, OSError):
-            return {"version": "2.0", "files": {}}
-    
-    def save_cache_metadata(self):
-        """Save cache metadata to disk."""
-        try:
-            os.makedirs(os.path.dirname(self.cache_metadata_file), exist_ok=True)
-            
-            temp_fd, temp_path = tempfile.mkstemp(
-                dir=os.path.dirname(self.cache_metadata_file),
-                prefix='.metadata_tmp_'
-            )
+            conn = sqlite3.connect(self.cache_db_file, isolation_level=None,
+                                   check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript(_CACHE_SCHEMA)
             
+            # Indexes created before media files were tracked
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(files)")}
+            if "media_filename" not in columns:
+                conn.execute("ALTER TABLE files ADD COLUMN media_filename TEXT")
+        except sqlite3.Error as e:
+            # Keep caching for this session even if the index can't be stored
+            print(f"Gemini TTS: Cache index unavailable - {e}")
+            conn = sqlite3.connect(":memory:", isolation_level=None,
+                                   check_same_thread=False)
+            conn.executescript(_CACHE_SCHEMA)
+        else:
+            # Only an index that persists may take over (and delete) the old
+            # metadata; otherwise leave it for a later session to migrate
+            if os.path.exists(self.cache_metadata_file):
+                self.migrate_cache_metadata(conn)
+        
+        self._cache_entries, self._cache_bytes = conn.execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM files").fetchone()
+        return conn
+    
+    def migrate_cache_metadata(self, conn: sqlite3.Connection):
+        """Import the JSON cache metadata of older versions."""
+        try:
+            with open(self.cache_metadata_file, 'rb') as f:
+                files = _json_loads(f.read()).get("files", {})
+        except (ValueError, OSError, AttributeError):
+            files = {}
+        
+        # Older metadata was keyed by filename rather than cache key
+        files = {
+            (key[:-4] if key.endswith('.wav') else key): info
+            for key, info in files.items()
+        }
+        
+        rows = []
+        for cache_key, file_info in files.items():
             try:
-                with os.fdopen(temp_fd, 'w', encoding='utf-8') as f:
-                    json.dump(self.cache_metadata, f, indent=2)
-                
-                os.rename(temp_path, self.cache_metadata_file)
-                
-            except:
-                try:
-                    os.unlink(temp_path)
-                except:
-                    pass
-                raise
-                
+                size = os.path.getsize(os.path.join(self.cache_dir, cache_key + '.wav'))
+            except OSError:
+                continue
+            created = file_info.get("created", 0)
+            rows.append((cache_key, created, file_info.get("accessed", created), size))
+        
+        try:
+            conn.execute("BEGIN")
+            conn.executemany(
+                "INSERT OR IGNORE INTO files (cache_key, created, accessed, size) "
+                "VALUES (?, ?, ?, ?)", rows)
+            conn.execute("COMMIT")
+        except sqlite3.Error:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            return
+        
+        try:
+            os.remove(self.cache_metadata_file)
         except OSError:
             pass
     
+    def close_connections(self):
+        """Stop the batch workers and close the pooled API connections."""
+        self._batch_executor.shutdown(wait=False, cancel_futures=True)
+        self._http.close()
+    
+    def close_cache_index(self):
+        """Close the cache index connection, if it was opened."""
+        with self._meta_lock:
+            self._cache_db_closed = True
+            if self._cache_db_conn is not None:
+                self._cache_db_conn.close()
+                self._cache_db_conn = None
+    
     def create_cache_dir(self):
         """Create cache directory if it doesn't exist."""
         try:
-            if not self.cache_dir.startswith(mw.col.media.dir()):
+            if not self.cache_dir.startswith(self._media_dir_prefix):
                 raise ValueError("Security error: Cache directory outside media folder")
             os.makedirs(self.cache_dir, exist_ok=True)
         except OSError:
             pass
     
+    def is_in_media_dir(self, path: str) -> bool:
+        """Check that a path resolves to a file inside the media folder."""
+        path = os.path.abspath(path)
+        try:
+            return (os.path.commonpath([path, self._media_dir]) == self._media_dir
+                    and path != self._media_dir)
+        except ValueError:  # Different drives on Windows
+            return False
+    
     def get_cache_key(self, text: str, processing_mode: str = None) -> str:
         """Generate cache key including processing mode and settings."""
-        if processing_mode is None:
-            processing_mode = self.config.get("processing_mode", "unified")
+        with self._config_lock:
+            if processing_mode is None:
+                processing_mode = self.config.get("processing_mode", "unified")
+            
+            settings = self._cache_key_settings.get(processing_mode)
+            if settings is None:
+                settings = self._cache_key_settings[processing_mode] = \
+                    self._encode_cache_key_settings(processing_mode)
         
+        return _compute_cache_key(text, settings)
+    
+    def _encode_cache_key_settings(self, processing_mode: str) -> bytes:
+        """Encode the settings part of the cache key (cached until save_config)."""
         # Include relevant settings in cache key
         voice = self.config.get("voice", "Zephyr")
         model = self.config.get("model", "flash_unified")
@@ -508,205 +882,358 @@ Generate natural speech text:"""
         if processing_mode == "unified":
             style = self.config.get("preprocessing_style", "natural")
             thinking_budget = self.config.get("thinking_budget", 0)
-            content = f"{text}:{voice}:{model}:{temperature}:{processing_mode}:{style}:{thinking_budget}"
+            settings = f":{voice}:{model}:{temperature}:{processing_mode}:{style}:{thinking_budget}"
         else:
-            content = f"{text}:{voice}:{model}:{temperature}:{processing_mode}"
+            settings = f":{voice}:{model}:{temperature}:{processing_mode}"
         
-        return hashlib.md5(content.encode('utf-8')).hexdigest()
+        return settings.encode('utf-8')
+    
+    def get_session_audio(self, cache_key: str) -> Optional[str]:
+        """Return the media file already produced for this key in this session."""
+        with self._meta_lock:
+            if not self.config.get("enable_cache", True):
+                return None
+            
+            filename = self._session_cache.get(cache_key)
+            if filename is None:
+                return None
+            
+            if not os.path.exists(os.path.join(self._media_dir, filename)):
+                del self._session_cache[cache_key]
+                return None
+            
+            self._session_cache.move_to_end(cache_key)
+            return filename
+    
+    def remember_session_audio(self, cache_key: str, filename: str):
+        """Remember the media file produced for a cache key."""
+        with self._meta_lock:
+            self._session_cache[cache_key] = filename
+            self._session_cache.move_to_end(cache_key)
+            while len(self._session_cache) > _SESSION_CACHE_SIZE:
+                self._session_cache.popitem(last=False)
     
     def get_cached_audio(self, cache_key: str) -> Optional[str]:
         """Check if audio is cached and not expired."""
-        if not self.config.get("enable_cache", True):
-            return None
-        
-        cache_file = os.path.join(self.cache_dir, f"{cache_key}.wav")
-        
-        if not cache_file.startswith(self.cache_dir):
+        try:
+            return self._lookup_cached_audio(cache_key)
+        except sqlite3.Error as e:
+            # Index closed or unusable; generate the audio instead
+            print(f"Gemini TTS: Cache lookup skipped - {e}")
             return None
-        
-        # Check metadata first
-        filename = f"{cache_key}.wav"
-        if filename in self.cache_metadata["files"]:
-            file_info = self.cache_metadata["files"][filename]
-            file_age = time.time() - file_info["created"]
+    
+    def _lookup_cached_audio(self, cache_key: str) -> Optional[str]:
+        """Return a media file for a cached, unexpired cache key."""
+        with self._meta_lock:
+            if not self.config.get("enable_cache", True):
+                return None
+            
+            cache_file = os.path.join(self.cache_dir, f"{cache_key}.wav")
+            
+            if not cache_file.startswith(self._cache_dir_prefix):
+                return None
+            
+            # The index is authoritative for what the cache holds
+            row = self._cache_db.execute(
+                "SELECT created, media_filename FROM files WHERE cache_key = ?",
+                (cache_key,)).fetchone()
+            if row is None:
+                return None
+            
+            file_age = time.time() - row[0]
             max_age = self.config.get("cache_days", 30) * 24 * 3600
             
             if file_age > max_age:
-                del self.cache_metadata["files"][filename]
-                self.save_cache_metadata()
+                self._forget_cache_file(cache_key)
                 try:
                     os.remove(cache_file)
                 except OSError:
                     pass
                 return None
-        
-        # Verify file actually exists
-        if not os.path.exists(cache_file):
-            if filename in self.cache_metadata["files"]:
-                del self.cache_metadata["files"][filename]
-                self.save_cache_metadata()
-            return None
-        
-        # Update access time
-        self.update_cache_access(cache_key)
-        
-        # Copy cached file to media collection with unique name
-        timestamp = int(time.time())
-        dest_filename = f"gemini_tts_{cache_key[:8]}_{timestamp}.wav"
-        dest_path = os.path.join(mw.col.media.dir(), dest_filename)
-        
-        if not dest_path.startswith(mw.col.media.dir()):
-            return None
-        
-        try:
-            with open(cache_file, 'rb') as src, open(dest_path, 'wb') as dst:
-                dst.write(src.read())
+            
+            # Hand out the same media file again while Anki still has it
+            media_filename = row[1]
+            if media_filename:
+                media_path = os.path.join(self._media_dir, media_filename)
+                if self.is_in_media_dir(media_path) and os.path.exists(media_path):
+                    self.update_cache_access(cache_key)
+                    return media_filename
+            
+            # Copy cached file to media collection with unique name
+            timestamp = int(time.time())
+            dest_filename = f"gemini_tts_{cache_key[:8]}_{timestamp}.wav"
+            dest_path = os.path.join(self._media_dir, dest_filename)
+            
+            if not dest_path.startswith(self._media_dir_prefix):
+                return None
+            
+            try:
+                # Hardlink when possible; fall back to a reflink or copy
+                try:
+                    os.link(cache_file, dest_path)
+                except FileExistsError:
+                    pass  # Same key and second, so the same audio
+                except FileNotFoundError:
+                    raise
+                except OSError:
+                    _clone_file(cache_file, dest_path)
+            except FileNotFoundError:
+                # Cache file is gone, so the index entry is stale
+                self._forget_cache_file(cache_key)
+                return None
+            except OSError:
+                return None
+            
+            self._cache_db.execute(
+                "UPDATE files SET accessed = ?, media_filename = ? WHERE cache_key = ?",
+                (time.time(), dest_filename, cache_key))
             return dest_filename
-        except OSError:
-            return None
     
-    def cache_audio(self, cache_key: str, audio_data: bytes):
-        """Cache audio data to disk with atomic writes."""
+    def cache_audio(self, cache_key: str, audio_data: Tuple[bytes, bytes],
+                    source_path: str = None):
+        """Cache audio data to disk with atomic writes.
+        
+        If source_path already holds the same audio, it is hardlinked into
+        the cache instead of writing the bytes a second time.
+        """
         if not self.config.get("enable_cache", True):
             return
         
         cache_file = os.path.join(self.cache_dir, f"{cache_key}.wav")
         
-        if not cache_file.startswith(self.cache_dir):
+        if not cache_file.startswith(self._cache_dir_prefix):
             return
         
-        try:
-            temp_fd, temp_path = tempfile.mkstemp(
-                dir=self.cache_dir,
-                prefix=f'.cache_tmp_{cache_key[:8]}_',
-                suffix='.wav'
-            )
-            
+        size = sum(map(len, audio_data))
+        media_filename = os.path.basename(source_path) if source_path else None
+        
+        if not (source_path and self._link_into_cache(cache_key, source_path, cache_file)):
             try:
-                with os.fdopen(temp_fd, 'wb') as f:
-                    f.write(audio_data)
+                temp_path = self._cache_temp_path(cache_key)
+                temp_fd = os.open(temp_path, _TEMP_OPEN_FLAGS, 0o644)
                 
-                os.rename(temp_path, cache_file)
-                self.track_cache_file(cache_key)
-                
-            except:
                 try:
-                    os.unlink(temp_path)
+                    try:
+                        for part in audio_data:
+                            _write_all(temp_fd, part)
+                    finally:
+                        os.close(temp_fd)
+                    
+                    os.replace(temp_path, cache_file)
+                    
                 except:
-                    pass
-                raise
-                
-        except OSError:
-            pass
-    
-    def track_cache_file(self, cache_key: str):
-        """Track a cache file in metadata."""
-        filename = f"{cache_key}.wav"
-        current_time = time.time()
-        
-        self.cache_metadata["files"][filename] = {
-            "created": current_time,
-            "accessed": current_time,
-            "version": "2.0"
-        }
+                    try:
+                        os.unlink(temp_path)
+                    except:
+                        pass
+                    raise
+                    
+            except OSError:
+                return
         
-        self.save_cache_metadata()
+        try:
+            self.track_cache_file(cache_key, size, media_filename)
+            self.enforce_cache_size_limit()
+        except sqlite3.Error as e:
+            # The media file is already saved; only caching is skipped. An
+            # unindexed cache file would never be served or evicted.
+            print(f"Gemini TTS: Cache index update skipped - {e}")
+            try:
+                os.remove(cache_file)
+            except OSError:
+                pass
     
-    def update_cache_access(self, cache_key: str):
-        """Update access time for cache file."""
-        filename = f"{cache_key}.wav"
+    def _cache_temp_path(self, cache_key: str) -> str:
+        """Return a fresh temp file path in the cache directory.
         
-        if filename in self.cache_metadata["files"]:
-            self.cache_metadata["files"][filename]["accessed"] = time.time()
-            self.save_cache_metadata()
+        Callers create it exclusively, so a name clash fails instead of
+        overwriting another writer's file.
+        """
+        return os.path.join(self.cache_dir,
+                            f'.cache_tmp_{cache_key[:8]}_{os.urandom(4).hex()}.wav')
     
-    def cleanup_cache(self) -> int:
-        """Clean up expired cache files."""
-        if not os.path.exists(self.cache_dir):
-            return 0
+    def _link_into_cache(self, cache_key: str, source_path: str, cache_file: str) -> bool:
+        """Atomically hardlink an existing file into the cache."""
+        temp_path = self._cache_temp_path(cache_key)
         
-        cleaned = 0
-        max_age = self.config.get("cache_days", 30) * 24 * 3600
-        current_time = time.time()
+        try:
+            os.link(source_path, temp_path)
+        except OSError:
+            return False  # Cross-device or unsupported; caller writes a copy
         
-        files_to_remove = []
+        try:
+            os.replace(temp_path, cache_file)
+        except OSError:
+            try:
+                os.unlink(temp_path)
+            except OSError:
+                pass
+            return False
         
-        for filename, file_info in self.cache_metadata["files"].items():
-            file_age = current_time - file_info["created"]
-            if file_age > max_age:
-                files_to_remove.append(filename)
+        return True
+    
+    def track_cache_file(self, cache_key: str, size: int, media_filename: str = None):
+        """Track a cache file, and the media file holding the same audio, in the index."""
+        with self._meta_lock:
+            current_time = time.time()
+            self._forget_cache_file(cache_key)
+            self._cache_db.execute(
+                "INSERT INTO files (cache_key, created, accessed, size, media_filename) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (cache_key, current_time, current_time, size, media_filename))
+            self._cache_entries += 1
+            self._cache_bytes += size
+    
+    def _forget_cache_file(self, cache_key: str):
+        """Drop a cache entry from the index and the running totals."""
+        row = self._cache_db.execute(
+            "SELECT size FROM files WHERE cache_key = ?", (cache_key,)).fetchone()
+        if row is not None:
+            self._cache_db.execute("DELETE FROM files WHERE cache_key = ?", (cache_key,))
+            self._cache_entries -= 1
+            self._cache_bytes -= row[0]
+    
+    def _remove_cache_files(self, rows) -> int:
+        """Delete (cache_key, size) rows from the index and their files."""
+        if not rows:
+            return 0
         
-        for filename in files_to_remove:
-            file_path = os.path.join(self.cache_dir, filename)
+        conn = self._cache_db
+        try:
+            conn.execute("BEGIN")
+            conn.executemany(
+                "DELETE FROM files WHERE cache_key = ?", [(cache_key,) for cache_key, _ in rows])
+            conn.execute("COMMIT")
+        except sqlite3.Error:
+            # Nothing was removed, so the files and running totals stay as-is
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            return 0
+        
+        removed = 0
+        self._cache_entries -= len(rows)
+        for cache_key, size in rows:
+            self._cache_bytes -= size
             try:
-                if os.path.exists(file_path):
-                    os.remove(file_path)
-                    cleaned += 1
+                os.remove(os.path.join(self.cache_dir, cache_key + '.wav'))
+                removed += 1
             except OSError:
                 pass
+        return removed
+    
+    def enforce_cache_size_limit(self) -> int:
+        """Evict least recently used cache files until under the size and count limits."""
+        with self._meta_lock:
+            max_bytes = self.config.get("cache_max_mb", 500) * 1024 * 1024
+            excess_bytes = self._cache_bytes - max_bytes
+            excess_entries = self._cache_entries - self.config.get("cache_max_entries", 5000)
+            if excess_bytes <= 0 and excess_entries <= 0:
+                return 0
             
-            if filename in self.cache_metadata["files"]:
-                del self.cache_metadata["files"][filename]
-        
-        # Clean up orphaned temporary files
+            # Least recently used first; never evict the entry that was just added
+            cursor = self._cache_db.execute(
+                "SELECT cache_key, size FROM files ORDER BY accessed LIMIT ?",
+                (self._cache_entries - 1,))
+            
+            victims = []
+            for cache_key, size in cursor:
+                if excess_bytes <= 0 and excess_entries <= 0:
+                    break
+                victims.append((cache_key, size))
+                excess_bytes -= size
+                excess_entries -= 1
+            cursor.close()
+            
+            return self._remove_cache_files(victims)
+    
+    def update_cache_access(self, cache_key: str):
+        """Update access time for cache file."""
+        with self._meta_lock:
+            self._cache_db.execute(
+                "UPDATE files SET accessed = ? WHERE cache_key = ?", (time.time(), cache_key))
+    
+    def _background_cleanup(self):
+        """Run cleanup_cache() off the main thread, logging any failure."""
         try:
-            for filename in os.listdir(self.cache_dir):
-                if filename.startswith('.cache_tmp_') and filename.endswith('.wav'):
-                    temp_path = os.path.join(self.cache_dir, filename)
-                    try:
-                        if current_time - os.path.getmtime(temp_path) > 3600:
-                            os.remove(temp_path)
-                            cleaned += 1
-                    except OSError:
-                        pass
-        except OSError:
-            pass
-        
-        if files_to_remove:
-            self.save_cache_metadata()
+            cleaned = self.cleanup_cache()
+            if cleaned:
+                print(f"Gemini TTS: Removed {cleaned} expired cache files")
+        except Exception as e:
+            print(f"Gemini TTS: Cache cleanup error - {e}")
+    
+    def cleanup_cache(self) -> int:
+        """Clean up expired cache files.
         
-        return cleaned
+        Expired entries are found through the created index, so only they
+        are visited; get_cached_audio() applies the same rule on lookup.
+        """
+        with self._meta_lock:
+            if not os.path.exists(self.cache_dir):
+                return 0
+            
+            max_age = self.config.get("cache_days", 30) * 24 * 3600
+            current_time = time.time()
+            
+            cleaned = self._remove_cache_files(self._cache_db.execute(
+                "SELECT cache_key, size FROM files WHERE created < ?",
+                (current_time - max_age,)).fetchall())
+            
+            cleaned += self.enforce_cache_size_limit()
+            
+            # Clean up orphaned temporary files
+            try:
+                with os.scandir(self.cache_dir) as entries:
+                    for entry in entries:
+                        name = entry.name
+                        if name.startswith('.cache_tmp_') and name.endswith('.wav'):
+                            try:
+                                if current_time - entry.stat().st_mtime > 3600:
+                                    os.remove(entry.path)
+                                    cleaned += 1
+                            except OSError:
+                                pass
+            except OSError:
+                pass
+            
+            return cleaned
     
     # ========================================================================
     # AUDIO GENERATION AND PROCESSING
     # ========================================================================
     
-    def convert_to_wav(self, audio_data: bytes, mime_type: str) -> bytes:
-        """Convert raw audio data to WAV format."""
-        sample_rate = 24000
-        if 'rate=' in mime_type:
-            try:
-                rate_str = mime_type.split('rate=')[1].split(';')[0]
-                sample_rate = int(rate_str)
-            except (ValueError, IndexError):
-                pass
+    def convert_to_wav(self, audio_data: bytes, mime_type: str) -> Tuple[bytes, bytes]:
+        """Convert raw audio data to WAV format.
         
-        channels = 1
-        bits_per_sample = 16
-        bytes_per_sample = bits_per_sample // 8
-        byte_rate = sample_rate * channels * bytes_per_sample
-        block_align = channels * bytes_per_sample
-        data_size = len(audio_data)
+        The header is returned separately from the PCM data so that writers
+        can emit both without concatenating a full-size copy.
         
-        header = struct.pack(
-            '<4sI4s4sIHHIIHH4sI',
-            b'RIFF', 36 + data_size, b'WAVE', b'fmt ', 16, 1, channels,
-            sample_rate, byte_rate, block_align, bits_per_sample,
-            b'data', data_size
-        )
+        Returns:
+            (header, audio_data)
+        """
+        data_size = len(audio_data)
         
-        return header + audio_data
+        header = b''.join((
+            b'RIFF', _WAV_SIZE.pack(36 + data_size),
+            _wav_header_body(_sample_rate_from_mime(mime_type)),
+            _WAV_SIZE.pack(data_size)
+        ))
+        return header, audio_data
     
-    def generate_audio(self, text: str) -> str:
-        """Main audio generation method with intelligent mode selection."""
+    def prepare_text(self, text: str) -> Tuple[str, bool, str]:
+        """Clean up text and pick its processing mode and cache key.
+        
+        Returns:
+            (text, use_unified, cache_key)
+        """
         text = text.strip()
         if not text:
             raise ValueError("No text provided")
         
-        text = text.replace('\x00', '')
+        if '\x00' in text:
+            text = text.replace('\x00', '')
         
         if len(text) > 5000:
-            raise ValueError("Text too long (max 5000 characters)")
+            raise TextTooLongError("Text too long (max 5000 characters)")
         
         # Determine processing mode
         use_unified = self.should_use_unified_mode(text)
@@ -714,8 +1241,23 @@ Generate natural speech text:"""
         
         # Generate cache key
         cache_key = self.get_cache_key(text, processing_mode)
+        
+        return text, use_unified, cache_key
+    
+    def generate_audio(self, text: str) -> str:
+        """Main audio generation method with intelligent mode selection."""
+        return self._generate_prepared_audio(*self.prepare_text(text))
+    
+    def _generate_prepared_audio(self, text: str, use_unified: bool, cache_key: str) -> str:
+        """Return a media file for text prepared by prepare_text()."""
+        # Repeat requests in this session reuse the same media file
+        session_filename = self.get_session_audio(cache_key)
+        if session_filename:
+            return session_filename
+        
         cached_filename = self.get_cached_audio(cache_key)
         if cached_filename:
+            self.remember_session_audio(cache_key, cached_filename)
             return cached_filename
         
         # Generate audio with fallback handling
@@ -733,7 +1275,8 @@ Generate natural speech text:"""
                 try:
                     normalized_text = self.normalize_text(text)
                     audio_data = self.generate_audio_http(normalized_text)
-                    tooltip("Unified mode failed, used traditional mode")
+                    mw.taskman.run_on_main(
+                        partial(tooltip, "Unified mode failed, used traditional mode"))
                 except Exception as fallback_error:
                     raise e  # Raise original error if fallback also fails
             else:
@@ -743,18 +1286,55 @@ Generate natural speech text:"""
         timestamp = int(time.time())
         filename = f"gemini_tts_{cache_key[:8]}_{timestamp}.wav"
         
-        file_path = os.path.join(mw.col.media.dir(), filename)
-        if not file_path.startswith(mw.col.media.dir()):
+        file_path = os.path.join(self._media_dir, filename)
+        if not file_path.startswith(self._media_dir_prefix):
             raise ValueError("Security error: Invalid file path")
         
         with open(file_path, 'wb') as f:
-            f.write(audio_data)
+            f.writelines(audio_data)
         
-        # Cache the result
-        self.cache_audio(cache_key, audio_data)
+        # Cache the result, sharing the media file's data where possible
+        self.cache_audio(cache_key, audio_data, source_path=file_path)
+        self.remember_session_audio(cache_key, filename)
         
         return filename
     
+    def generate_audio_batch(self, texts: List[str]) -> List[Optional[str]]:
+        """Generate audio for many texts with concurrent API requests.
+        
+        Texts that share a cache key are generated once.
+        
+        Returns:
+            Media filenames in input order, None where generation failed
+        """
+        cache_keys = []
+        jobs = {}
+        for text in texts:
+            try:
+                prepared = self.prepare_text(text)
+            except ValueError as e:
+                print(f"Gemini TTS: Skipping batch text - {e}")
+                cache_keys.append(None)
+                continue
+            cache_keys.append(prepared[2])
+            jobs.setdefault(prepared[2], prepared)
+        
+        results = {}
+        if jobs:
+            # Requests are network-bound, so threads overlap them fine
+            futures = {
+                cache_key: self._batch_executor.submit(self._generate_prepared_audio, *job)
+                for cache_key, job in jobs.items()
+            }
+            
+            for cache_key, future in futures.items():
+                try:
+                    results[cache_key] = future.result()
+                except Exception as e:
+                    print(f"Gemini TTS: Batch generation error - {e}")
+        
+        return [results.get(cache_key) for cache_key in cache_keys]
+    
     # ========================================================================
     # TEXT PROCESSING AND NORMALIZATION
     # ========================================================================
@@ -764,74 +1344,74 @@ Generate natural speech text:"""
         if not text:
             return ""
         
-        # Remove HTML tags
-        import re
-        text = re.sub(r'<[^>]+>', '', text)
+        # Remove HTML tags (most selections are plain text)
+        if '<' in text:
+            text = _HTML_TAG_RE.sub('', text)
         
         # Unescape HTML entities
         text = html.unescape(text)
         
+        # Normalize whitespace characters before lines and spaces are
+        # handled, so zero-width spaces can't hide markers or leave gaps
+        text = text.translate(_WS_TABLE)
+        
         # Handle bullet points and list markers
-        bullet_patterns = [
-            r'^[\s]*[•·‣⁃▪▫‧◦⦾⦿]\s*',
-            r'^[\s]*[-*+]\s*',
-            r'^[\s]*\d+[.)]\s*',
-            r'^[\s]*[a-zA-Z][.)]\s*',
-        ]
-        
-        lines = text.split('\n')
         cleaned_lines = []
         
-        for line in lines:
-            line = line.strip()
-            if not line:
-                continue
-            
-            for pattern in bullet_patterns:
-                line = re.sub(pattern, '', line, flags=re.MULTILINE)
-                line = line.strip()
-            
+        for line in text.split('\n'):
+            line = line[_BULLET_PREFIX_RE.match(line).end():].strip()
             if line:
                 cleaned_lines.append(line)
         
-        text = ' '.join(cleaned_lines)
-        text = re.sub(r'\s+', ' ', text)
-        text = text.strip()
-        
-        # Normalize whitespace characters
-        text = text.replace('\u00a0', ' ')  # Non-breaking space
-        text = text.replace('\u2000', ' ')  # En quad
-        text = text.replace('\u2001', ' ')  # Em quad
-        text = text.replace('\u2002', ' ')  # En space
-        text = text.replace('\u2003', ' ')  # Em space
-        text = text.replace('\u2009', ' ')  # Thin space
-        text = text.replace('\u200b', '')   # Zero-width space
-        
-        return text
+        return _WS_RE.sub(' ', ' '.join(cleaned_lines)).strip()
     
     # ========================================================================
     # ANKI EDITOR INTEGRATION
     # ========================================================================
     
-    def add_audio_to_note(self, editor, filename: str):
-        """Add generated audio to the detected source field in Anki note."""
-        target_field = self.detect_source_field(editor)
+    def add_audio_to_note(self, editor, filename: str, note=None, target_field=None):
+        """Add generated audio to the detected source field in Anki note.
         
-        if target_field not in editor.note:
+        note and target_field are captured when generation starts. If the
+        editor has moved on to another note by the time audio is ready, the
+        captured note is updated in the collection instead.
+        """
+        if note is None:
+            note = editor.note
+        if target_field is None:
+            target_field = self.detect_source_field(editor)
+        
+        if target_field not in note:
             tooltip(f"Field '{target_field}' not found")
             return False
         
+        in_editor = editor.note is note
+        if not in_editor:
+            if not note.id:
+                # Closed without being added; there is nothing to update
+                tooltip("Note was closed before audio was ready")
+                return False
+            # Pick up any edits saved since generation started
+            note.load()
+        
         sound_tag = f"[sound:{filename}]"
-        current_content = editor.note[target_field]
+        current_content = note[target_field]
         
         if sound_tag not in current_content:
-            if current_content.strip():
-                editor.note[target_field] = f"{current_content} {sound_tag}"
-            else:
-                editor.note[target_field] = sound_tag
+            # Trim trailing whitespace so repeated additions stay single-spaced
+            content = current_content.rstrip()
+            note[target_field] = (
+                f"{content} {sound_tag}" if content else sound_tag
+            )
         
-        editor.loadNote()
-        QTimer.singleShot(100, lambda: self.focus_editor(editor))
+        if in_editor:
+            editor.loadNote()
+            QTimer.singleShot(100, lambda: self.focus_editor(editor))
+        else:
+            try:
+                mw.col.update_note(note)
+            except AttributeError:
+                note.flush()
         return True
     
     def focus_editor(self, editor):
@@ -845,10 +1425,6 @@ Generate natural speech text:"""
     def setup_editor_button(self, buttons, editor):
         """Add enhanced TTS buttons to editor toolbar."""
         try:
-            addon_dir = os.path.dirname(os.path.dirname(__file__))
-            icon_path = os.path.join(addon_dir, "icons", "gemini.png")
-            use_icon = icon_path if os.path.exists(icon_path) else None
-            
             # Get current settings for tooltip
             model_info = self.get_current_model_info()
             processing_mode = self.config.get("processing_mode", "unified")
@@ -859,43 +1435,26 @@ Generate natural speech text:"""
                    f"Mode: {processing_mode.title()}\n"
                    f"Voice: {current_voice}")
             
-            # Main TTS button
-            button = editor.addButton(
-                icon=use_icon,
-                cmd="gemini_tts",
-                tip=tip,
-                func=lambda ed: self.on_button_click(ed),
-                keys="Ctrl+G"
+            # (cmd, icon, label, tip, handler, keys) for each toolbar button
+            specs = (
+                ("gemini_tts", _ICON_OR_NONE, "", tip,
+                 self.on_button_click, "Ctrl+G"),
+                ("gemini_mode", None, f"Mode: {processing_mode[:3].title()}",
+                 f"Processing Mode: {processing_mode.title()}\nClick to change",
+                 self.show_mode_menu, None),
+                ("gemini_model", None, "Model",
+                 f"Model: {model_info['display_name']}\nClick to change",
+                 self.show_model_menu, None),
+                ("gemini_voice", None, "Voice",
+                 f"Voice: {current_voice}\nClick to change",
+                 self.show_voice_menu, None),
             )
             
-            # Mode selection button
-            mode_button = editor.addButton(
-                None,
-                cmd="gemini_mode",
-                tip=f"Processing Mode: {processing_mode.title()}\nClick to change",
-                func=lambda ed: self.show_mode_menu(ed),
-                label=f"Mode: {processing_mode[:3].title()}"
-            )
-            
-            # Model selection button
-            model_button = editor.addButton(
-                None,
-                cmd="gemini_model",
-                tip=f"Model: {model_info['display_name']}\nClick to change",
-                func=lambda ed: self.show_model_menu(ed),
-                label="Model"
-            )
-            
-            # Voice selection button  
-            voice_button = editor.addButton(
-                None,
-                cmd="gemini_voice", 
-                tip=f"Voice: {current_voice}\nClick to change",
-                func=lambda ed: self.show_voice_menu(ed),
-                label="Voice"
-            )
-            
-            buttons.extend([button, mode_button, model_button, voice_button])
+            # addButton() only returns HTML; nothing is added unless all succeed
+            buttons.extend([
+                editor.addButton(icon, cmd, handler, tip=tip, label=label, keys=keys)
+                for cmd, icon, label, tip, handler, keys in specs
+            ])
             
         except Exception as e:
             print(f"Gemini TTS: Button setup error - {e}")
@@ -907,103 +1466,80 @@ Generate natural speech text:"""
         menu = QMenu(editor.widget)
         current_mode = self.config.get("processing_mode", "unified")
         
-        modes = [
-            ("unified", "Unified (AI + TTS)"),
-            ("traditional", "Traditional (TTS Only)"),
-            ("hybrid", "Hybrid (Auto-Select)"),
-            ("auto", "Auto-Detect")
-        ]
-        
-        for mode_key, mode_name in modes:
+        for mode_key, mode_name in _PROCESSING_MODE_MENU:
             action = menu.addAction(mode_name)
             action.setCheckable(True)
             action.setChecked(mode_key == current_mode)
-            action.triggered.connect(lambda checked, mk=mode_key: self.change_processing_mode(mk))
+            action.triggered.connect(partial(self._on_menu_choice, self.change_processing_mode, mode_key))
         
         menu.exec(QCursor.pos())
     
     def show_model_menu(self, editor):
         """Show model selection menu."""
         menu = QMenu(editor.widget)
-        models = self.get_available_models()
         current_model = self.config.get("model", "flash_unified")
         
-        for model_key, model_info in models.items():
+        for model_key, model_info in _AVAILABLE_MODELS.items():
             action = menu.addAction(model_info["display_name"])
             action.setCheckable(True)
             action.setChecked(model_key == current_model)
-            action.triggered.connect(lambda checked, mk=model_key: self.change_model(mk))
+            action.triggered.connect(partial(self._on_menu_choice, self.change_model, model_key))
         
         menu.exec(QCursor.pos())
     
     def show_voice_menu(self, editor):
         """Show voice selection menu."""
         menu = QMenu(editor.widget)
-        voices = self.get_available_voices()
         current_voice = self.config.get("voice", "Zephyr")
         
-        for voice in voices:
+        for voice in _AVAILABLE_VOICES:
             action = menu.addAction(voice)
             action.setCheckable(True)
             action.setChecked(voice == current_voice)
-            action.triggered.connect(lambda checked, v=voice: self.change_voice(v))
+            action.triggered.connect(partial(self._on_menu_choice, self.change_voice, voice))
         
         menu.exec(QCursor.pos())
     
+    def _on_menu_choice(self, change, value, checked=False):
+        """Menu action slot; QAction.triggered also passes the checked state."""
+        change(value)
+    
+    def _change(self, key: str, value: Any, message: str):
+        """Apply a toolbar setting change now and save it shortly after.
+        
+        Changes made within 300 ms of each other share one draft config
+        and are written to the collection together by flush_config().
+        """
+        if self._pending_config is None:
+            self._pending_config = self.config.copy()
+            QTimer.singleShot(300, self.flush_config)
+        self._pending_config[key] = value
+        self.apply_config(self._pending_config)
+        tooltip(message)
+    
     def change_processing_mode(self, mode_key):
         """Change processing mode and update configuration."""
-        config = self.config.copy()
-        config["processing_mode"] = mode_key
-        self.save_config(config)
-        
         mode_names = {
             "unified": "Unified (AI + TTS)",
             "traditional": "Traditional",
             "hybrid": "Hybrid",
             "auto": "Auto-Detect"
         }
-        tooltip(f"Processing mode: {mode_names.get(mode_key, mode_key)}")
+        self._change("processing_mode", mode_key,
+                     f"Processing mode: {mode_names.get(mode_key, mode_key)}")
     
     def change_model(self, model_key):
         """Change model and update configuration."""
-        config = self.config.copy()
-        config["model"] = model_key
-        self.save_config(config)
-        
-        model_info = self.get_available_models()[model_key]
-        tooltip(f"Model: {model_info['display_name']}")
+        model_info = _AVAILABLE_MODELS[model_key]
+        self._change("model", model_key, f"Model: {model_info['display_name']}")
     
     def change_voice(self, voice):
         """Change voice and update configuration."""
-        config = self.config.copy()
-        config["voice"] = voice
-        self.save_config(config)
-        tooltip(f"Voice: {voice}")
+        self._change("voice", voice, f"Voice: {voice}")
 
     def on_button_click(self, editor):
         """Handle TTS button click in editor."""
-        js_code = """
-        (function() {
-            const selection = window.getSelection();
-            if (selection.rangeCount > 0) {
-                const range = selection.getRangeAt(0);
-                const container = document.createElement('div');
-                container.appendChild(range.cloneContents());
-                return {
-                    plainText: selection.toString(),
-                    htmlContent: container.innerHTML,
-                    hasContent: selection.toString().length > 0
-                };
-            }
-            return {
-                plainText: '',
-                htmlContent: '',
-                hasContent: false
-            };
-        })();
-        """
-        
-        editor.web.evalWithCallback(js_code, partial(self.process_selection_result, editor))
+        editor.web.evalWithCallback(_SELECTION_JS, partial(self.process_selection_result, editor))
     
     def process_selection_result(self, editor, result):
         """Process the selection result from JavaScript."""
@@ -1011,7 +1547,7 @@ Generate natural speech text:"""
             tooltip("Please select some text first")
             return
         
-        raw_text = result.get('plainText', '') or result.get('htmlContent', '')
+        raw_text = result.get('plainText', '')
         
         if not raw_text.strip():
             tooltip("No readable text found in selection")
@@ -1044,32 +1580,42 @@ Generate natural speech text:"""
         else:
             tooltip("Generating TTS...")
         
-        QTimer.singleShot(100, lambda: self.generate_and_add_audio(editor, selected_text))
+        self.generate_and_add_audio(editor, selected_text)
     
     def generate_and_add_audio(self, editor, text):
-        """Generate audio and add to note (non-blocking operation)."""
+        """Generate audio in the background and add to note (non-blocking operation)."""
+        # Bind the result to this note/field; the editor may move on meanwhile
+        mw.taskman.run_in_background(
+            partial(self.generate_audio, text),
+            partial(self.on_audio_generated, editor, editor.note,
+                    self.detect_source_field(editor))
+        )
+    
+    def on_audio_generated(self, editor, note, target_field, future):
+        """Add generated audio to the note once the background task finishes."""
         try:
-            filename = self.generate_audio(text)
+            filename = future.result()
             
-            if self.add_audio_to_note(editor, filename):
-                model_info = self.get_current_model_info()
-                current_voice = self.config.get("voice", "Zephyr")
-                processing_mode = self.config.get("processing_mode", "unified")
-                
-                tooltip(f"Audio generated: {model_info['display_name']} ({processing_mode}) - {current_voice}")
-            else:
-                tooltip("Failed to add audio to note")
+            if self.add_audio_to_note(editor, filename, note, target_field):
+                # Built once per config; see apply_config()
+                message = self._success_message
+                if message is None:
+                    model_info = self.get_current_model_info()
+                    current_voice = self.config.get("voice", "Zephyr")
+                    processing_mode = self.config.get("processing_mode", "unified")
+                    message = self._success_message = (
+                        f"Audio generated: {model_info['display_name']} "
+                        f"({processing_mode}) - {current_voice}")
+                tooltip(message)
+            # Otherwise add_audio_to_note() has already said why
                 
+        except ApiKeyError:
+            tooltip("Invalid API key - check configuration")
+        except RateLimitError:
+            tooltip("Rate limited - wait and try again")
+        except NetworkError:
+            tooltip("Network error - check connection")
+        except TextTooLongError:
+            tooltip("Text too long - select shorter text")
         except Exception as e:
-            error_msg = str(e)
-            
-            if "API key" in error_msg:
-                tooltip("Invalid API key - check configuration")
-            elif "Rate limited" in error_msg:
-                tooltip("Rate limited - wait and try again")
-            elif "Network error" in error_msg:
-                tooltip("Network error - check connection")
-            elif "too long" in error_msg:
-                tooltip("Text too long - select shorter text")
-            else:
-                tooltip(f"Error: {error_msg[:50]}...")
\ No newline at end of file
+            tooltip(f"Error: {str(e)[:50]}...")
\ No newline at end of file